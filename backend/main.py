@@ -1,78 +1,404 @@
 # main.py
 import os
+import ssl
+import time
+import queue
+import logging
+import hashlib
+import functools
+import asyncio
+import httpx
+import orjson
+import asyncmy
 import uvicorn
-import mysql.connector
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from asyncmy.cursors import SSCursor
+from asyncmy.errors import MySQLError
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from contextlib import asynccontextmanager
+from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, field_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Annotated, Literal, Optional
 
-# AI and LangChain imports
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+__all__ = ["app"]
 
-load_dotenv()
+# --- Configuration ---
+class Settings(BaseSettings):
+    """Environment configuration, validated once at import so misconfiguration fails fast."""
+    # Resolved next to this file, so backend/.env is found whatever directory the server starts from.
+    model_config = SettingsConfigDict(env_file=Path(__file__).with_name(".env"), extra="ignore")
+
+    OPENAI_API_KEY: str
+    DB_HOST: str
+    DB_PORT: int = 4000
+    DB_USER: str
+    DB_PASSWORD: str
+    DB_NAME: str
+    DB_SSL_CA: Optional[str] = None
+    DB_POOL_MIN_SIZE: int = 5
+    DB_POOL_MAX_SIZE: int = 20
+    # Connections older than this (seconds) are replaced instead of reused, so sockets the
+    # server has already dropped for idleness aren't handed to a request.
+    DB_POOL_RECYCLE: int = 300
+    # After a failed pool creation, requests skip the database for this long (seconds) instead of
+    # each waiting out another round of connect timeouts.
+    DB_RETRY_COOLDOWN: int = 30
+    # Load FRONTEND_ORIGIN from environment variables. It's crucial this is set correctly in Railway.
+    FRONTEND_ORIGIN: str = "http://localhost:3000"
+    # Cheap model handles most requests; the high-quality model is only used on escalation.
+    # Point LLM_BASE_URL at an OpenAI-compatible server (e.g. vLLM with an AWQ model) to self-host the fast tier.
+    FAST_MODEL: str = "gpt-4o-mini"
+    HQ_MODEL: str = "gpt-4o"
+    LLM_BASE_URL: Optional[str] = None
+    ESCALATION_MIN_CHARS: int = 200
+    # Upper bound on generated tokens per analysis; keeps cost and generation time predictable.
+    LLM_MAX_TOKENS: int = 600
+    ANALYSIS_CACHE_TTL: int = 3600
+    # Optional Redis cache shared by all workers; leave unset to use only the in-process cache.
+    REDIS_URL: Optional[str] = None
+    # Caps in-flight LLM calls per worker; keep workers * this below the account's rate limit.
+    OPENAI_MAX_CONCURRENCY: int = 16
+    # Set to WARNING in production to skip the per-request info entries entirely. Limited to the
+    # levels both logging and Uvicorn accept, so a typo fails here rather than at server start.
+    LOG_LEVEL: Literal["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"] = "INFO"
+    PORT: int = 8080
+    WEB_CONCURRENCY: int = Field(default_factory=lambda: os.cpu_count() or 2)
+
+    @field_validator("LOG_LEVEL", mode="before")
+    @classmethod
+    def normalize_log_level(cls, value):
+        return value.upper() if isinstance(value, str) else value
+
+settings = Settings()
+
+# --- Logging ---
+# Records are queued and written by a background listener thread, so the event loop never blocks on stderr.
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+
+logger = logging.getLogger("agri")
+logger.setLevel(settings.LOG_LEVEL)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+
+# --- LLM Chains ---
+# Static instructions go in the system message so the per-request human message holds only data.
+SYSTEM_PROMPT = (
+    "You are an expert agronomist advising farmers in the Western Cape, South Africa. "
+    'From the data given, reply concisely with a "Risk Assessment" and a "Recommended Action".'
+)
+HUMAN_PROMPT = (
+    "Location: {location}\n"
+    "Crop: {crop_type}\n"
+    "14-day forecast: {weather}\n"
+    "Satellite NDVI: {satellite}\n"
+    "Historical precedent (TiDB): {history}"
+)
+
+@functools.cache
+def get_chains() -> tuple:
+    """Returns the (fast, high-quality) chains, built once per process on first use."""
+    # LangChain is imported here rather than at module top so cold starts and health checks
+    # don't pay for loading the LLM stack until an analysis is actually requested.
+    from langchain_openai import ChatOpenAI
+    from langchain.prompts import ChatPromptTemplate
+
+    llm_fast = ChatOpenAI(
+        model=settings.FAST_MODEL,
+        openai_api_key=settings.OPENAI_API_KEY,
+        base_url=settings.LLM_BASE_URL,
+        max_tokens=settings.LLM_MAX_TOKENS,
+        streaming=True,
+        # llm_retry is the only retry layer, so backoff never sleeps while holding a permit.
+        max_retries=0,
+    )
+    llm_hq = ChatOpenAI(
+        model=settings.HQ_MODEL,
+        openai_api_key=settings.OPENAI_API_KEY,
+        max_tokens=settings.LLM_MAX_TOKENS,
+        streaming=True,
+        # llm_retry is the only retry layer, so backoff never sleeps while holding a permit.
+        max_retries=0,
+    )
+    prompt = ChatPromptTemplate.from_messages([("system", SYSTEM_PROMPT), ("human", HUMAN_PROMPT)])
+    return prompt | llm_fast, prompt | llm_hq
+
+def needs_escalation(analysis: str) -> bool:
+    """Flags fast-tier answers that are too short or skip the sections the prompt asks for."""
+    text = analysis.lower()
+    return (
+        len(analysis) < settings.ESCALATION_MIN_CHARS
+        or "risk assessment" not in text
+        or "recommended action" not in text
+    )
+
+# --- OpenAI Throttling ---
+# Bursts queue on this semaphore instead of piling into OpenAI and degrading into 429 retry storms.
+openai_semaphore = asyncio.Semaphore(settings.OPENAI_MAX_CONCURRENCY)
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    from openai import RateLimitError
+    return isinstance(exc, RateLimitError)
+
+# Permits are released before each backoff sleep, so a retrying call never blocks others.
+llm_retry = retry(
+    retry=retry_if_exception(is_rate_limit_error),
+    wait=wait_random_exponential(multiplier=1, max=20),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+@llm_retry
+async def invoke_llm(chain, prompt_inputs: dict) -> str:
+    """Invokes `chain` under the concurrency cap, retrying rate-limit errors with jittered backoff."""
+    async with openai_semaphore:
+        response = await chain.ainvoke(prompt_inputs)
+    return response.content
+
+@llm_retry
+async def open_llm_stream(chain, prompt_inputs: dict) -> tuple:
+    """Starts streaming `chain`, retrying rate-limit errors until the first chunk arrives.
+
+    Returns (first_chunk, stream) while holding an openai_semaphore permit; the caller must
+    release it once the stream is exhausted. first_chunk is None for an empty stream.
+    """
+    await openai_semaphore.acquire()
+    stream = chain.astream(prompt_inputs)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        openai_semaphore.release()
+        await stream.aclose()
+        raise
+    return first, stream
+
+async def stream_llm(chain, prompt_inputs: dict, frames: asyncio.Queue) -> str:
+    """Streams `chain` into `frames` as {"t": token} frames and returns the full text."""
+    first, stream = await open_llm_stream(chain, prompt_inputs)
+    tokens = []
+    try:
+        chunk = first
+        while chunk is not None:
+            if chunk.content:
+                tokens.append(chunk.content)
+                frames.put_nowait({"t": chunk.content})
+            chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        pass
+    finally:
+        openai_semaphore.release()
+        await stream.aclose()
+    return "".join(tokens)
+
+# --- TiDB Connection Pool ---
+# Pooled connections reuse the TCP + TLS session instead of handshaking on every request.
+# Session settings applied once per pooled connection. asyncmy sends queries over the text
+# protocol, so TiDB's non-prepared plan cache is what lets the repeated history lookup skip
+# parsing and planning; 1PC and async commit keep any future writes on TiDB's fast commit paths.
+# The non-prepared plan cache variable needs TiDB >= 7.0; older clusters reject the whole SET, so
+# create_db_pool falls back to default session settings there.
+DB_INIT_COMMAND = (
+    "SET SESSION tidb_enable_non_prepared_plan_cache = ON, "
+    "tidb_enable_1pc = ON, "
+    "tidb_enable_async_commit = ON"
+)
+
+# MySQL error code TiDB returns for a SET on a variable it doesn't know.
+ER_UNKNOWN_SYSTEM_VARIABLE = 1193
+
+async def open_db_pool(init_command: Optional[str]):
+    ssl_ctx = ssl.create_default_context(cafile=settings.DB_SSL_CA)
+    return await asyncmy.create_pool(
+        host=settings.DB_HOST,
+        port=settings.DB_PORT,
+        user=settings.DB_USER,
+        password=settings.DB_PASSWORD,
+        database=settings.DB_NAME,
+        ssl=ssl_ctx,
+        init_command=init_command,
+        # Single-statement reads don't need an implicit BEGIN/COMMIT round-trip.
+        autocommit=True,
+        minsize=settings.DB_POOL_MIN_SIZE,
+        maxsize=settings.DB_POOL_MAX_SIZE,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+
+async def create_db_pool():
+    """Creates the TiDB pool, or returns None so the API can still start without a database."""
+    try:
+        try:
+            return await open_db_pool(DB_INIT_COMMAND)
+        except MySQLError as err:
+            if not err.args or err.args[0] != ER_UNKNOWN_SYSTEM_VARIABLE:
+                raise
+            # The session tuning is an optimisation only; don't let an older TiDB lose its pool over it.
+            logger.warning("TiDB rejected the session settings (%s); using server defaults.", err)
+            return await open_db_pool(None)
+    except (MySQLError, OSError) as err:
+        # Keep the API up; get_db_pool retries once DB_RETRY_COOLDOWN has passed.
+        logger.error("TiDB connection pool could not be created: %s", err)
+        return None
+
+async def connect_db_pool() -> None:
+    """Creates the pool into app.state, recording when the attempt failed."""
+    try:
+        app.state.db_pool = await create_db_pool()
+        if app.state.db_pool is None:
+            app.state.db_pool_failed_at = time.monotonic()
+    finally:
+        app.state.db_pool_attempt = None
+
+async def get_db_pool():
+    """Returns the TiDB pool, creating it if startup (or an earlier retry) couldn't."""
+    if app.state.db_pool is None:
+        attempt = app.state.db_pool_attempt
+        if attempt is None:
+            if time.monotonic() - app.state.db_pool_failed_at < settings.DB_RETRY_COOLDOWN:
+                return None
+            attempt = app.state.db_pool_attempt = asyncio.create_task(connect_db_pool())
+        # Every caller shares the attempt in progress, and a caller that is cancelled doesn't
+        # cancel it for the rest.
+        await asyncio.shield(attempt)
+    return app.state.db_pool
+
+# --- Redis Client ---
+def create_redis_client():
+    """Connects to Redis when REDIS_URL is set; the shared cache is skipped otherwise."""
+    if not settings.REDIS_URL:
+        return None
+    import redis.asyncio as redis
+    return redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+# --- Warm-up ---
+async def warm_up(app: FastAPI) -> None:
+    """Pays the first DB round-trip, LangChain import and OpenAI handshake before real traffic does."""
+    try:
+        db_pool = await get_db_pool()
+        if db_pool is not None:
+            async with db_pool.acquire() as connection:
+                await connection.ping()
+        # The import is blocking, so build the chains off the event loop.
+        chain_fast, _ = await asyncio.to_thread(get_chains)
+        await chain_fast.last.ainvoke("ping", max_tokens=1)
+        logger.info("Warm-up complete.")
+    except Exception as e:
+        # Requests still work cold; they'll just pay the setup cost themselves.
+        logger.warning("Warm-up failed: %s", e)
+    finally:
+        app.state.ready = True
+
+# --- App Lifespan ---
+# Runs once per worker process, so each Uvicorn worker owns its own HTTP client and DB pool.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    # A single AsyncClient is reused across requests so outbound calls don't block the event loop,
+    # keep-alive reuses TLS sessions, and HTTP/2 multiplexes concurrent calls to the same host.
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=10.0,
+    )
+    app.state.db_pool_attempt = None
+    app.state.db_pool_failed_at = float("-inf")
+    await connect_db_pool()
+    app.state.redis = create_redis_client()
+    # Warm in the background so the server starts accepting requests (and answering /) immediately.
+    app.state.ready = False
+    warm_task = asyncio.create_task(warm_up(app))
+    try:
+        yield
+    finally:
+        warm_task.cancel()
+        await app.state.http_client.aclose()
+        if app.state.db_pool is not None:
+            app.state.db_pool.close()
+            await app.state.db_pool.wait_closed()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+        log_listener.stop()
 
 # --- FastAPI App Initialization ---
-app = FastAPI(title="Agri-Intel Agent Backend")
+app = FastAPI(title="Agri-Intel Agent Backend", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- CORS Middleware ---
-# Load FRONTEND_ORIGIN from environment variables. It's crucial this is set correctly in Railway.
-frontend_origin = os.getenv("FRONTEND_ORIGIN", "http://localhost:3000")
-origins = [frontend_origin, "http://localhost:3000"]
+origins = [settings.FRONTEND_ORIGIN, "http://localhost:3000"]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # Explicit lists (rather than "*") plus max_age let browsers cache the preflight for a day.
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,
 )
 
+# --- Response Compression ---
+# Analysis text compresses well; Starlette leaves text/event-stream uncompressed so SSE isn't buffered.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # --- Pydantic Model for API Input ---
+# Strips whitespace and rejects empty or oversized values before any data is fetched.
+FarmField = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=128)]
+
 class FarmDataRequest(BaseModel):
-    farm_location: str
-    crop_type: str
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    farm_location: FarmField
+    crop_type: FarmField
+
+class FarmDataBatchRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    items: list[FarmDataRequest] = Field(min_length=1, max_length=50)
 
 # --- Data Fetching Functions ---
-def get_weather_data(location: str) -> dict:
+async def get_weather_data(location: str) -> dict:
     """Fetches real-time weather data for a given location."""
-    print(f"Fetching mock weather data for {location}...")
+    # Real API calls should go through app.state.http_client, e.g. `await app.state.http_client.get(url)`.
+    logger.debug("Fetching mock weather data for %s...", location)
     return {"forecast": "14-day forecast shows high humidity and rising temperatures."}
 
-def get_satellite_data(location: str) -> dict:
+async def get_satellite_data(location: str) -> dict:
     """Fetches satellite imagery and NDVI analysis data."""
-    print(f"Fetching mock satellite data for {location}...")
+    logger.debug("Fetching mock satellite data for %s...", location)
     return {"ndvi_analysis": "NDVI readings indicate moderate plant stress in Block B."}
 
-def query_tidb_history(location: str, crop: str) -> dict:
-    """Connects to the TiDB Serverless database and queries historical data."""
-    print(f"Connecting to TiDB for historical data for {location}...")
+HISTORY_QUERY = "SELECT historical_precedent_column FROM historical_data WHERE location = %s AND crop = %s LIMIT 1"
+
+async def query_tidb_history(location: str, crop: str) -> dict:
+    """Queries the TiDB Serverless database for historical data using the shared pool."""
+    logger.debug("Querying TiDB for historical data for %s...", location)
+    db_pool = await get_db_pool()
+    if db_pool is None:
+        return {"historical_precedent": "TiDB connection error: connection pool is unavailable."}
     try:
-        connection = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            port=int(os.getenv("DB_PORT", "4000")),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_NAME"),
-            ssl_ca=os.getenv("DB_SSL_CA")
-        )
-        cursor = connection.cursor(buffered=True)
-        query = "SELECT historical_precedent_column FROM historical_data WHERE location = %s AND crop = %s LIMIT 1"
-        cursor.execute(query, (location, crop))
-        result = cursor.fetchone()
-        connection.close()
+        async with db_pool.acquire() as connection:
+            # Unbuffered: we only ever read the single row the LIMIT allows.
+            async with connection.cursor(SSCursor) as cursor:
+                await cursor.execute(HISTORY_QUERY, (location, crop))
+                result = await cursor.fetchone()
 
         if result:
             return {"historical_precedent": result[0]}
         else:
             return {"historical_precedent": "No similar historical data found in TiDB."}
 
-    except mysql.connector.Error as err:
+    except MySQLError as err:
         # Capture and report the specific database error
         error_message = f"TiDB connection or query error: {err}"
-        print(error_message)
+        logger.error(error_message)
         return {"historical_precedent": error_message}
 
 # --- Health Check Endpoint ---
@@ -80,54 +406,330 @@ def query_tidb_history(location: str, crop: str) -> dict:
 def read_root():
     return {"message": "Agri-Intel Agent is running!"}
 
-# --- Main AI Analysis Endpoint ---
-@app.post("/api/get-farm-analysis")
-def get_farm_analysis(request: FarmDataRequest):
-    print(f"Received request for analysis: {request}")
-    weather_data = get_weather_data(request.farm_location)
-    satellite_data = get_satellite_data(request.farm_location)
-    historical_data = query_tidb_history(request.farm_location, request.crop_type)
-    
+# --- Readiness Probe ---
+@app.get("/healthz")
+async def healthz():
+    """Returns 200 once warm-up has finished and TiDB is reachable, so platforms can hold traffic until then."""
+    if not app.state.ready:
+        return ORJSONResponse({"status": "warming"}, status_code=503)
+    # Doubles as the lazy reconnect, so the probe turns healthy on the first retry after TiDB is back.
+    if await get_db_pool() is None:
+        return ORJSONResponse({"status": "database unavailable"}, status_code=503)
+    return {"status": "ready"}
+
+# --- AI Analysis Helpers ---
+async def gather_prompt_inputs(request: FarmDataRequest) -> dict:
+    """Fetches all data sources for a request and returns the prompt variables."""
+    # The three data sources are independent, so fetch them concurrently.
+    weather_data, satellite_data, historical_data = await asyncio.gather(
+        get_weather_data(request.farm_location),
+        get_satellite_data(request.farm_location),
+        query_tidb_history(request.farm_location, request.crop_type),
+    )
+
     # Check for errors from data sources before invoking the LLM
     if "error" in historical_data.get("historical_precedent", "").lower():
         raise HTTPException(status_code=500, detail=historical_data["historical_precedent"])
 
+    return {
+        "location": request.farm_location,
+        "crop_type": request.crop_type,
+        "weather": weather_data['forecast'],
+        "satellite": satellite_data['ndvi_analysis'],
+        "history": historical_data['historical_precedent']
+    }
+
+# --- Shared Response Cache ---
+# Keyed on the full prompt inputs, so a hit is only served when the underlying data is unchanged.
+def shared_cache_key(prompt_inputs: dict) -> str:
+    raw = "|".join(prompt_inputs[name] for name in ("location", "crop_type", "weather", "satellite", "history"))
+    return "farm:" + hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+async def get_shared_analysis(key: str) -> Optional[str]:
+    if app.state.redis is None:
+        return None
+    try:
+        return await app.state.redis.get(key)
+    except Exception as e:
+        # The cache is best-effort; a Redis outage must not fail the request.
+        logger.warning("Redis cache read failed: %s", e)
+        return None
+
+async def set_shared_analysis(key: str, analysis: str) -> None:
+    if app.state.redis is None:
+        return
     try:
-        llm = ChatOpenAI(model="gpt-4o", openai_api_key=os.getenv("OPENAI_API_KEY"))
-        prompt_template = ChatPromptTemplate.from_template(
-            """
-            You are an expert AI agronomist for farmers in the Western Cape, South Africa.
-            Your task is to provide a clear, actionable recommendation based on the data provided.
-
-            DATA:
-            - Location: {location}
-            - Crop Type: {crop_type}
-            - 14-Day Weather Forecast: {weather}
-            - Satellite NDVI Analysis: {satellite}
-            - Historical Precedent from TiDB: {history}
-
-            Based on all of this data, provide a "Risk Assessment" and a "Recommended Action".
-            Format your response clearly and concisely.
-            """
-        )
-        chain = prompt_template | llm
-        print("Invoking AI agent...")
-        response = chain.invoke({
-            "location": request.farm_location,
-            "crop_type": request.crop_type,
-            "weather": weather_data['forecast'],
-            "satellite": satellite_data['ndvi_analysis'],
-            "history": historical_data['historical_precedent']
-        })
-        print("AI response received.")
-        return {"status": "success", "analysis": response.content}
+        await app.state.redis.set(key, analysis, ex=settings.ANALYSIS_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Redis cache write failed: %s", e)
+
+async def generate(chain, prompt_inputs: dict, frames: Optional[asyncio.Queue]) -> str:
+    if frames is None:
+        return await invoke_llm(chain, prompt_inputs)
+    return await stream_llm(chain, prompt_inputs, frames)
+
+async def analyze_prompt(prompt_inputs: dict, frames: Optional[asyncio.Queue] = None) -> str:
+    """Returns the analysis for one set of prompt inputs, escalating weak fast-tier answers.
+
+    With `frames`, tokens are also streamed into it as SSE payloads while they are generated.
+    """
+    key = shared_cache_key(prompt_inputs)
+    analysis = await get_shared_analysis(key)
+    if analysis is not None:
+        logger.info("Serving analysis from shared cache.")
+        if frames is not None:
+            frames.put_nowait({"t": analysis})
+        return analysis
+
+    chain_fast, chain_hq = get_chains()
+    analysis = await generate(chain_fast, prompt_inputs, frames)
+    if needs_escalation(analysis):
+        logger.info("Fast-tier answer failed the quality check; escalating to %s.", settings.HQ_MODEL)
+        if frames is not None:
+            # Tells the client to discard the fast-tier text before the escalated answer streams in.
+            frames.put_nowait({"reset": True})
+        analysis = await generate(chain_hq, prompt_inputs, frames)
+    await set_shared_analysis(key, analysis)
+    return analysis
+
+async def run_analysis(request: FarmDataRequest, frames: Optional[asyncio.Queue] = None) -> str:
+    """Gathers the farm data and returns the LLM's analysis text."""
+    prompt_inputs = await gather_prompt_inputs(request)
+
+    try:
+        logger.debug("Invoking AI agent...")
+        analysis = await analyze_prompt(prompt_inputs, frames)
+        logger.debug("AI response received.")
+        return analysis
     except Exception as e:
         # Return a more specific error message from the exception
         error_detail = f"LLM or data processing error: {e}"
-        print(f"Error invoking LLM: {e}")
+        logger.error("Error invoking LLM: %s", e)
+        if frames is not None:
+            # A streaming client already has its headers, so it is told in-band too.
+            frames.put_nowait({"error": error_detail})
         raise HTTPException(status_code=500, detail=error_detail)
 
+# --- Analysis Cache ---
+# Repeat requests for the same farm and crop skip both the data fetch and the LLM call.
+analysis_cache = TTLCache(maxsize=1024, ttl=settings.ANALYSIS_CACHE_TTL)
+
+def analysis_cache_key(request: FarmDataRequest) -> tuple:
+    """Canonicalizes location and crop so trivially different spellings share an entry."""
+    return (
+        " ".join(request.farm_location.split()).lower(),
+        " ".join(request.crop_type.split()).lower(),
+    )
+
+# --- In-flight Request Coalescing ---
+# Concurrent identical requests share one analysis instead of each calling the LLM.
+inflight_analyses = {}
+# Callers still waiting on each run. When the last one disconnects the run is cancelled, so
+# nothing keeps fetching data or holding an OpenAI permit for an answer nobody will read.
+run_waiters = {}
+
+def forget_inflight(key: tuple, run: asyncio.Future) -> None:
+    if inflight_analyses.get(key) is run:
+        del inflight_analyses[key]
+    run_waiters.pop(run, None)
+    # Waiters re-raise the run's error themselves; this only marks it as retrieved.
+    if run.done() and not run.cancelled():
+        run.exception()
+
+def track_inflight(key: tuple, run: asyncio.Future) -> None:
+    inflight_analyses[key] = run
+    run.add_done_callback(functools.partial(forget_inflight, key))
+
+def add_waiter(run: asyncio.Future) -> None:
+    run_waiters[run] = run_waiters.get(run, 0) + 1
+
+def drop_waiter(key: tuple, run: asyncio.Future) -> None:
+    remaining = run_waiters.get(run, 0) - 1
+    if remaining > 0:
+        run_waiters[run] = remaining
+        return
+    run_waiters.pop(run, None)
+    if not run.done():
+        logger.info("Every caller disconnected; cancelled the pending analysis.")
+        run.cancel()
+        # Unregister now rather than when the cancellation lands, so a new request starts afresh.
+        forget_inflight(key, run)
+
+async def wait_for_run(key: tuple, run: asyncio.Future) -> str:
+    """Awaits a shared run as one of its waiters."""
+    add_waiter(run)
+    try:
+        # Shield so one caller leaving doesn't cancel the run while others still wait on it.
+        return await asyncio.shield(run)
+    finally:
+        drop_waiter(key, run)
+
+def start_analysis(key: tuple, request: FarmDataRequest, frames: Optional[asyncio.Queue] = None) -> asyncio.Task:
+    """Starts the run for `key` in the background and registers it as in flight."""
+    async def analyze_and_cache():
+        analysis = await run_analysis(request, frames)
+        analysis_cache[key] = analysis
+        return analysis
+
+    task = asyncio.create_task(analyze_and_cache())
+    track_inflight(key, task)
+    return task
+
+async def analyze_once(key: tuple, request: FarmDataRequest) -> str:
+    """Runs the analysis for `key`, or joins the run already in progress for it."""
+    task = inflight_analyses.get(key)
+    if task is None:
+        task = start_analysis(key, request)
+    else:
+        logger.info("Joining in-flight analysis.")
+    return await wait_for_run(key, task)
+
+# --- Client Disconnects ---
+async def wait_for_disconnect(http_request: Request) -> None:
+    # The request body has already been read, so the next ASGI message is the disconnect.
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def cancel_on_disconnect(http_request: Request, coro):
+    """Awaits `coro`, cancelling it if the client goes away first.
+
+    Cancelling a wait_for_run drops that caller; the shared run itself stops with its last waiter.
+    """
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(http_request))
+    try:
+        done, _ = await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+    if work not in done:
+        logger.info("Client disconnected; stopped waiting for the analysis.")
+        raise HTTPException(status_code=499, detail="Client closed request.")
+    return work.result()
+
+# --- Main AI Analysis Endpoint ---
+@app.post("/api/get-farm-analysis")
+async def get_farm_analysis(request: FarmDataRequest, http_request: Request):
+    logger.info("Received request for analysis: %s", request)
+    key = analysis_cache_key(request)
+    analysis = analysis_cache.get(key)
+    if analysis is None:
+        analysis = await cancel_on_disconnect(http_request, analyze_once(key, request))
+    else:
+        logger.info("Serving analysis from cache.")
+    return {"status": "success", "analysis": analysis}
+
+# --- Batch AI Analysis Endpoint ---
+# Runs go through analyze_once, so they are shared with concurrent single requests; one the
+# batch alone is waiting on stops if the batch client disconnects.
+def batch_result(outcome) -> dict:
+    if isinstance(outcome, BaseException):
+        return {"status": "error", "detail": getattr(outcome, "detail", str(outcome))}
+    return {"status": "success", "analysis": outcome}
+
+@app.post("/api/get-farm-analyses")
+async def get_farm_analyses(batch: FarmDataBatchRequest, http_request: Request):
+    """Analyzes several farms in one request; results are returned in input order."""
+    logger.info("Received batch request for %d analyses", len(batch.items))
+    keys = [analysis_cache_key(item) for item in batch.items]
+    outcomes = {key: analysis_cache.get(key) for key in keys}
+    # One run per distinct farm; duplicate items in the batch share its result.
+    pending = {key: item for key, item in zip(keys, batch.items) if outcomes[key] is None}
+
+    if pending:
+        logger.info("Analyzing %d distinct farms...", len(pending))
+        # Concurrency is bounded by openai_semaphore, shared with every other request.
+        # A failed item is reported on its own; the others are still returned and cached.
+        results = await cancel_on_disconnect(http_request, asyncio.gather(
+            *(analyze_once(key, item) for key, item in pending.items()),
+            return_exceptions=True,
+        ))
+        outcomes.update(zip(pending, results))
+
+    items = [batch_result(outcomes[key]) for key in keys]
+    status = "success" if all(item["status"] == "success" for item in items) else "partial"
+    return {"status": status, "results": items}
+
+# --- Streaming AI Analysis Endpoint ---
+# Frames are built as bytes with orjson so Starlette doesn't re-encode every token.
+SSE_DONE = b"data: [DONE]\n\n"
+
+def sse_frame(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def next_frame(run: asyncio.Future, frames: asyncio.Queue) -> Optional[dict]:
+    """Waits for the run's next frame; returns None once the run has finished and been drained."""
+    while frames.empty() and not run.done():
+        getter = asyncio.ensure_future(frames.get())
+        try:
+            done, _ = await asyncio.wait({getter, run}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # A cancelled Queue.get leaves its item in the queue, so nothing is lost here.
+            if not getter.done():
+                getter.cancel()
+        if getter in done:
+            return getter.result()
+    return None if frames.empty() else frames.get_nowait()
+
+@app.post("/api/get-farm-analysis/stream")
+async def stream_farm_analysis(request: FarmDataRequest, http_request: Request):
+    """Streams the analysis as Server-Sent Events so the client sees tokens as they arrive."""
+    logger.info("Received streaming request for analysis: %s", request)
+    key = analysis_cache_key(request)
+    cached = analysis_cache.get(key)
+    if cached is None and key in inflight_analyses:
+        logger.info("Joining in-flight analysis.")
+        cached = await cancel_on_disconnect(http_request, wait_for_run(key, inflight_analyses[key]))
+    if cached is not None:
+        logger.info("Serving analysis from cache.")
+
+        async def cached_gen():
+            yield sse_frame({"t": cached})
+            yield SSE_DONE
+
+        return StreamingResponse(cached_gen(), media_type="text/event-stream")
+
+    # Generation runs in a background task that writes frames to a queue, so the OpenAI permit is
+    # held only while tokens are produced, not while a slow client reads them. The task is
+    # registered before its first await, so duplicates arriving during the data fetch join it.
+    logger.info("Streaming AI agent response...")
+    frames = asyncio.Queue()
+    run = start_analysis(key, request, frames)
+    # This request is a waiter until frame_gen finishes, so a disconnect mid-stream (Starlette
+    # cancels or closes the generator) stops the run unless a coalesced caller still needs it.
+    add_waiter(run)
+    try:
+        # Wait for the first frame so data errors still map to an HTTP status before streaming starts.
+        first = await cancel_on_disconnect(http_request, next_frame(run, frames))
+        if first is None:
+            run.result()
+    except BaseException:
+        drop_waiter(key, run)
+        raise
+
+    async def frame_gen():
+        try:
+            frame = first
+            while frame is not None:
+                yield sse_frame(frame)
+                frame = await next_frame(run, frames)
+            yield SSE_DONE
+        finally:
+            drop_waiter(key, run)
+
+    return StreamingResponse(frame_gen(), media_type="text/event-stream")
+
 # --- Entry Point for Uvicorn ---
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", 8080))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    # One event loop per worker; uvloop and httptools are used whenever they are installed.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=settings.PORT,
+        workers=settings.WEB_CONCURRENCY,
+        loop="auto",
+        http="auto",
+        # At WARNING and above Uvicorn also stops writing an access-log line per request.
+        log_level=settings.LOG_LEVEL.lower(),
+    )
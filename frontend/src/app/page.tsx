@@ -43,7 +43,8 @@ export default function Home() {
     try {
       // The fix is here: remove the leading slash from the path.
       // Use string interpolation to construct the URL without a double slash.
-      const response = await fetch(`${apiUrl}api/get-farm-analysis`, {
+      // The stream endpoint sends Server-Sent Events, so tokens render as they are generated.
+      const response = await fetch(`${apiUrl}api/get-farm-analysis/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -54,14 +55,42 @@ export default function Home() {
 
       clearInterval(interval);
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         const errorText = await response.text();
         console.error('API Error Response:', errorText);
         throw new Error(`HTTP error! Status: ${response.status}`);
       }
 
-      const data = await response.json();
-      setAnalysisResult(data.analysis);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let analysis = '';
+      setAnalysisResult('');
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Frames are separated by a blank line; keep any partial frame for the next chunk.
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop() ?? '';
+        for (const frame of frames) {
+          if (!frame.startsWith('data: ')) continue;
+          const payload = frame.slice('data: '.length);
+          if (payload === '[DONE]') continue;
+
+          const data = JSON.parse(payload);
+          if (data.error) throw new Error(data.error);
+          // The fast-tier answer was escalated; drop it before the better one streams in.
+          if (data.reset) {
+            analysis = '';
+          } else {
+            analysis += data.t;
+          }
+          setAnalysisResult(analysis);
+        }
+      }
 
     } catch (err) {
       clearInterval(interval);